@@ -3,10 +3,16 @@ from __future__ import annotations
 
 import os
 import re
+import tempfile
+import unicodedata
 from io import BytesIO
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
+import numpy as np
 import pandas as pd
+from cachetools import TTLCache, cached
 from flask import (
     Flask,
     render_template,
@@ -16,6 +22,7 @@ from flask import (
     flash,
     send_file,
     jsonify,
+    make_response,
 )
 
 from dotenv import load_dotenv
@@ -39,29 +46,45 @@ load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 SUPABASE_BUCKET = os.getenv("SUPABASE_BUCKET", "comissoes")
+# Tabela-índice dos df_final enviados (ver supabase/migrations/)
+SUPABASE_INDEX_TABLE = os.getenv("SUPABASE_INDEX_TABLE", "competencia_files")
 
-supabase: Client | None = None
-if SUPABASE_URL and SUPABASE_KEY:
+
+def criar_cliente_supabase() -> Client | None:
+    if not (SUPABASE_URL and SUPABASE_KEY):
+        print("⚠️ SUPABASE_URL ou SUPABASE_KEY não configurados. Upload ficará desativado.")
+        return None
     try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        return create_client(SUPABASE_URL, SUPABASE_KEY)
     except Exception as e:
         print("Erro ao criar client do Supabase:", e)
-        supabase = None
-else:
-    print("⚠️ SUPABASE_URL ou SUPABASE_KEY não configurados. Upload ficará desativado.")
+        return None
+
+
+# Com gunicorn --preload o módulo é importado antes do fork; o gunicorn.conf.py
+# recria o client em cada worker para não compartilhar conexões HTTP entre processos.
+supabase: Client | None = criar_cliente_supabase()
 
 # =====================================================================
 # 3) PASTA DE OUTPUT LOCAL (APENAS PARA RODAR NA MÁQUINA / DEBUG)
 # =====================================================================
 
-if os.getenv("VERCEL"):
+# Na Vercel (serverless) ninguém lê o disco local entre requisições: nada é gravado
+# lá e os downloads passam todos pelo Supabase.
+IS_SERVERLESS = bool(os.getenv("VERCEL"))
+
+if IS_SERVERLESS:
     OUTPUT_DIR = "/tmp/outputs"
 else:
     OUTPUT_DIR = os.path.join(app.root_path, "outputs")
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+    try:
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+    except OSError as e:
+        # FS somente-leitura: downloads locais ficam indisponíveis, o resto funciona
+        print("Não consegui criar a pasta de outputs:", e)
 
-OUTPUT_FILES = {
+OUTPUT_FILES = {} if IS_SERVERLESS else {
     "df_final": os.path.join(OUTPUT_DIR, "df_final.xlsx"),
     "df_juntar": os.path.join(OUTPUT_DIR, "df_juntar.xlsx"),
     "pj1": os.path.join(OUTPUT_DIR, "pj1.xlsx"),
@@ -120,38 +143,42 @@ FONTE_ARQUIVOS_PREFIXO = {
 }
 
 
+FONTE_PREVIEW_LINHAS = 20
+
+
+# Palavra-chave (sem acento, minúscula) -> fonte. A ordem importa: vale o primeiro match.
+# O que não casar com nenhuma vira candidato a PJ1.
+PALAVRAS_CHAVE_FONTES = {
+    "seguro": "seg",
+    "cambio": "cam",
+    "terceiras": "co_ter",
+    "xpvp": "co_xpvp",
+    "credito": "cre",
+    "xpcs": "xpcs",
+    "lancamentos manuais": "lan_man",
+    "times e repasses": "tim_rep",
+    "lancamento de produtos": "lan_pro",
+}
+
+
+def normalizar_nome_arquivo(nome: str) -> str:
+    # "Câmbio.xlsx" -> "cambio.xlsx"
+    return unicodedata.normalize("NFKD", nome.lower()).encode("ascii", "ignore").decode("ascii")
+
+
 def classificar_arquivos(uploaded_files):
-    slots = {k: None for k in ["pj1", "seg", "cam", "co_ter", "co_xpvp", "cre", "xpcs", "lan_man", "tim_rep", "lan_pro"]}
-    usados = set()
+    slots = {k: None for k in FONTE_KEYS}
+    nao_usados = []
 
     for f in uploaded_files:
-        nome = (f.filename or "").lower()
-
-        def marca(chave):
-            if slots[chave] is None:
-                slots[chave] = f
-                usados.add((f.filename or "").lower())
-
-        if "seguro" in nome:
-            marca("seg")
-        elif "câmbio" in nome or "cambio" in nome:
-            marca("cam")
-        elif "terceiras" in nome:
-            marca("co_ter")
-        elif "xpvp" in nome:
-            marca("co_xpvp")
-        elif "crédito" in nome or "credito" in nome:
-            marca("cre")
-        elif "xpcs" in nome:
-            marca("xpcs")
-        elif "lançamentos manuais" in nome or "lancamentos manuais" in nome:
-            marca("lan_man")
-        elif "times e repasses" in nome:
-            marca("tim_rep")
-        elif "lançamento de produtos" in nome or "lancamento de produtos" in nome:
-            marca("lan_pro")
-
-    nao_usados = [f for f in uploaded_files if (f.filename or "").lower() not in usados]
+        nome = normalizar_nome_arquivo(f.filename or "")
+
+        chave = next((c for palavra, c in PALAVRAS_CHAVE_FONTES.items() if palavra in nome), None)
+        if chave is not None and slots[chave] is None:
+            slots[chave] = f
+        else:
+            nao_usados.append(f)
+
     if nao_usados and slots["pj1"] is None:
         slots["pj1"] = nao_usados[0]
 
@@ -159,10 +186,41 @@ def classificar_arquivos(uploaded_files):
     return slots, faltando
 
 
+def ler_excel(fonte) -> pd.DataFrame:
+    # calamine (Rust) é bem mais rápido que o openpyxl para ler .xlsx
+    try:
+        return pd.read_excel(fonte, engine="calamine")
+    except Exception as e:
+        # Planilha com algo que o calamine não entende: tenta com a engine padrão do pandas
+        print("calamine não conseguiu ler o Excel, tentando engine padrão:", e)
+        if hasattr(fonte, "seek"):
+            fonte.seek(0)
+        return pd.read_excel(fonte)
+
+
+def salvar_excel(df: pd.DataFrame, destino) -> None:
+    # xlsxwriter escreve bem mais rápido que o openpyxl (engine padrão do pandas)
+    df.to_excel(destino, index=False, engine="xlsxwriter")
+
+
+# Troca separadores do formato en-US (1,234.56) para pt-BR (1.234,56) numa única passada
+_BR_TRANS = str.maketrans({",": ".", ".": ","})
+
+
 def brl(valor: float) -> str:
     if pd.isna(valor):
         valor = 0.0
-    return f"R$ {valor:,.2f}".replace(",", "v").replace(".", ",").replace("v", ".")
+    return f"R$ {valor:,.2f}".translate(_BR_TRANS)
+
+
+def arredondar_numericos(df: pd.DataFrame) -> None:
+    """
+    Arredonda (in-place) as colunas float para 2 casas, uma coluna por vez:
+    o pico de memória é de uma coluna, não de todo o bloco numérico.
+    Colunas inteiras não precisam de arredondamento.
+    """
+    for col in df.select_dtypes(include=["float"]).columns:
+        df[col] = np.round(df[col].to_numpy(dtype=float, na_value=np.nan), 2)
 
 
 def _supabase_list(path: str):
@@ -176,16 +234,122 @@ def _supabase_list(path: str):
         return []
 
 
+INDEX_PAGINA = 1000  # limite padrão de linhas por resposta do PostgREST
+
+
+def _supabase_select_paginado(tabela: str, colunas: str, ordem: str, **filtros) -> list[dict]:
+    """
+    SELECT com filtros de igualdade, paginando de INDEX_PAGINA em INDEX_PAGINA linhas.
+    Ordena por `ordem` para as páginas serem estáveis (sem ORDER BY o Postgres não
+    garante a mesma ordem entre uma página e outra).
+    """
+    linhas = []
+    inicio = 0
+    while True:
+        query = supabase.table(tabela).select(colunas)
+        for coluna, valor in filtros.items():
+            query = query.eq(coluna, valor)
+        pagina = query.order(ordem).range(inicio, inicio + INDEX_PAGINA - 1).execute().data or []
+        linhas.extend(pagina)
+        if len(pagina) < INDEX_PAGINA:
+            return linhas
+        inicio += INDEX_PAGINA
+
+
+def _supabase_index_df_final(competencia: str | None = None) -> list[dict]:
+    """
+    Lê a tabela-índice (um SELECT indexado, bem mais barato que storage.list()).
+    Sem competência, lê a view de competências distintas.
+    Devolve [] se a tabela não existir ou estiver vazia para este bucket; aí quem
+    chama cai no storage.list() como antes.
+    """
+    if supabase is None:
+        return []
+    try:
+        if competencia:
+            return _supabase_select_paginado(
+                SUPABASE_INDEX_TABLE, "competencia, path", "path", bucket=SUPABASE_BUCKET, competencia=competencia
+            )
+        return _supabase_select_paginado(
+            f"{SUPABASE_INDEX_TABLE}_competencias", "competencia", "competencia", bucket=SUPABASE_BUCKET
+        )
+    except Exception as e:
+        print("Erro lendo índice no Supabase:", e)
+        return []
+
+
+def _popular_indice_pelo_storage():
+    """
+    Se o índice ainda não tem nada deste bucket, copia para ele os df_final que já
+    estão no storage. Sem isso, o primeiro registro novo faria todas as
+    competências antigas sumirem da listagem (que passa a vir só do índice).
+    """
+    if _supabase_index_df_final():
+        return
+
+    linhas = []
+    for it in _supabase_list(""):
+        comp = it.get("name", "")
+        if not _RE_COMPETENCIA.match(comp):
+            continue
+        for arq in _supabase_list(comp):
+            nome = arq.get("name", "")
+            if _RE_DF_FINAL_TS.match(nome) or _RE_DF_FINAL_V.match(nome):
+                linhas.append({"bucket": SUPABASE_BUCKET, "competencia": comp, "path": f"{comp}/{nome}"})
+
+    if linhas:
+        supabase.table(SUPABASE_INDEX_TABLE).upsert(linhas, on_conflict="bucket,path").execute()
+
+
+def registrar_df_final_no_indice(competencia: str, path: str) -> bool:
+    """
+    Registra o df_final no índice. Devolve False se não conseguiu: como a listagem
+    passa a vir do índice, uma versão fora dele fica invisível (e o número dela
+    seria reaproveitado), então quem chama trata isso como falha de upload.
+    """
+    if supabase is None:
+        return False
+    try:
+        _popular_indice_pelo_storage()
+        supabase.table(SUPABASE_INDEX_TABLE).upsert(
+            {"bucket": SUPABASE_BUCKET, "competencia": competencia, "path": path},
+            on_conflict="bucket,path",
+        ).execute()
+        return True
+    except Exception as e:
+        print("Erro registrando df_final no índice do Supabase:", e)
+        return False
+
+
+# -----------------------
+# CACHE DAS LISTAGENS (evita um storage.list() no Supabase a cada render)
+# -----------------------
+# As listagens só mudam quando o /processar sobe uma versão nova; ele invalida o cache.
+_cache_lock = Lock()
+_cache_competencias = TTLCache(maxsize=1, ttl=30)
+_cache_df_final = TTLCache(maxsize=256, ttl=30)
+
+
+def invalidar_cache_listagens(competencia: str):
+    with _cache_lock:
+        _cache_competencias.clear()
+        _cache_df_final.pop(competencia, None)
+
+
 # -----------------------
 # LISTAGEM DE COMPETÊNCIAS
 # -----------------------
+_RE_COMPETENCIA = re.compile(r"^\d{4}-\d{2}$")
+
+
+@cached(_cache_competencias, key=lambda: "competencias", lock=_cache_lock)
 def listar_competencias() -> list[str]:
-    itens = _supabase_list("")
-    comps = []
-    for it in itens:
-        nome = it.get("name", "")
-        if re.match(r"^\d{4}-\d{2}$", nome):
-            comps.append(nome)
+    linhas = _supabase_index_df_final()
+    if linhas:
+        nomes = [linha["competencia"] for linha in linhas]
+    else:
+        nomes = [it.get("name", "") for it in _supabase_list("")]
+    comps = [nome for nome in nomes if _RE_COMPETENCIA.match(nome)]
     return sorted(comps, reverse=True)
 
 
@@ -196,11 +360,16 @@ _RE_DF_FINAL_TS = re.compile(r"^df_final_(\d{8}_\d{6})\.xlsx$")
 _RE_DF_FINAL_V = re.compile(r"^df_final_v(\d+)\.xlsx$")
 
 
+@cached(_cache_df_final, key=lambda competencia: competencia, lock=_cache_lock)
 def listar_df_final_por_competencia(competencia: str) -> list[str]:
-    itens = _supabase_list(competencia)
+    linhas = _supabase_index_df_final(competencia)
+    if linhas:
+        nomes = [linha["path"].split("/")[-1] for linha in linhas]
+    else:
+        nomes = [it.get("name", "") for it in _supabase_list(competencia)]
+
     arquivos = []
-    for it in itens:
-        nome = it.get("name", "")
+    for nome in nomes:
         if _RE_DF_FINAL_TS.match(nome) or _RE_DF_FINAL_V.match(nome):
             arquivos.append(f"{competencia}/{nome}")
 
@@ -224,44 +393,206 @@ def escolher_mais_recente_df_final(competencia: str) -> str | None:
     return arquivos[0] if arquivos else None
 
 
-def supabase_download_bytes(path: str) -> bytes | None:
+# Bytes baixados por caminho: reabrir a mesma versão no /visualizar não baixa tudo
+# de novo. Guarda bytes (não DataFrames) porque os DataFrames são alterados depois
+# (ex.: arredondamento). O cache é por processo e substituir/deletar fonte
+# sobrescrevem arquivos no lugar, então só a visualização lê daqui
+# (usar_cache=True); quem vai recalcular e regravar sempre baixa do Supabase.
+# Todo download bem-sucedido atualiza o cache.
+_cache_downloads = TTLCache(maxsize=32, ttl=300)
+
+
+def supabase_download_bytes(path: str, logar_erro: bool = True, usar_cache: bool = False) -> bytes | None:
     if supabase is None:
         return None
+
+    if usar_cache:
+        with _cache_lock:
+            b = _cache_downloads.get(path)
+        if b is not None:
+            return b
+
     try:
         data = supabase.storage.from_(SUPABASE_BUCKET).download(path)
         if isinstance(data, (bytes, bytearray)):
-            return bytes(data)
-        if hasattr(data, "data"):
-            return data.data
+            b = bytes(data)
+        elif hasattr(data, "data"):
+            b = data.data
+        else:
+            return None
+    except Exception as e:
+        if logar_erro:
+            print("Erro no download do Supabase:", e)
         return None
+
+    if b:
+        with _cache_lock:
+            _cache_downloads[path] = b
+    return b
+
+
+def invalidar_cache_download(path: str):
+    with _cache_lock:
+        _cache_downloads.pop(path, None)
+
+
+# -----------------------
+# SIDECAR PARQUET: cada .xlsx no Supabase ganha um .parquet com os mesmos dados,
+# que é muito mais rápido de ler. O .xlsx continua sendo o arquivo "oficial".
+# -----------------------
+def caminho_parquet(path: str) -> str:
+    return path[: -len(".xlsx")] + ".parquet" if path.endswith(".xlsx") else path + ".parquet"
+
+
+def serializar_parquet(df: pd.DataFrame) -> bytes | None:
+    # Colunas com tipos misturados (ex.: número e texto) o pyarrow recusa: aí fica só o .xlsx
+    try:
+        buf = BytesIO()
+        df.to_parquet(buf, index=False, compression="zstd")
+        return buf.getvalue()
     except Exception as e:
-        print("Erro no download do Supabase:", e)
+        print("Não consegui gerar o parquet (fica só o .xlsx):", e)
         return None
 
 
-def carregar_excel_do_supabase(path: str) -> pd.DataFrame | None:
-    b = supabase_download_bytes(path)
+# .xlsx que sabidamente não têm sidecar (versões anteriores ao parquet): evita
+# um download que falha a cada visualização. Ficar desatualizado aqui é inofensivo,
+# no pior caso lê o .xlsx, que é sempre a fonte da verdade.
+_cache_sem_parquet = TTLCache(maxsize=4096, ttl=3600)
+
+
+def carregar_excel_do_supabase(path: str, usar_cache: bool = False) -> pd.DataFrame | None:
+    with _cache_lock:
+        sem_parquet = path in _cache_sem_parquet
+
+    if not sem_parquet:
+        b = supabase_download_bytes(caminho_parquet(path), logar_erro=False, usar_cache=usar_cache)
+        if b:
+            try:
+                return pd.read_parquet(BytesIO(b))
+            except Exception as e:
+                print("Erro lendo parquet, voltando para o .xlsx:", e)
+        with _cache_lock:
+            _cache_sem_parquet[path] = True
+
+    b = supabase_download_bytes(path, usar_cache=usar_cache)
     if not b:
         return None
-    return pd.read_excel(BytesIO(b))
+    return ler_excel(BytesIO(b))
+
+
+# Threads para I/O (rede/disco) feitas em paralelo
+MAX_WORKERS_IO = 8
+
+
+def carregar_excels_do_supabase(
+    caminhos: dict[str, str], usar_cache: bool = False
+) -> dict[str, pd.DataFrame | None]:
+    """Baixa e lê vários Excels do Supabase em paralelo; devolve {chave: df ou None}."""
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS_IO) as ex:
+        dfs = ex.map(lambda p: carregar_excel_do_supabase(p, usar_cache=usar_cache), caminhos.values())
+        return dict(zip(caminhos, dfs))
+
+
+def serializar_xlsx(df: pd.DataFrame) -> bytes:
+    buf = BytesIO()
+    salvar_excel(df, buf)
+    return buf.getvalue()
+
+
+CONTENT_TYPE_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+CONTENT_TYPE_PARQUET = "application/vnd.apache.parquet"
+
+
+def supabase_upload_bytes(conteudo: bytes, path: str):
+    if supabase is None:
+        raise RuntimeError("Supabase não configurado")
+
+    try:
+        supabase.storage.from_(SUPABASE_BUCKET).upload(
+            path=path,
+            file=conteudo,
+            file_options={
+                "content-type": CONTENT_TYPE_PARQUET if path.endswith(".parquet") else CONTENT_TYPE_XLSX,
+                "upsert": "true",
+            },
+        )
+    finally:
+        invalidar_cache_download(path)
 
 
 def supabase_upload_df_upsert(df: pd.DataFrame, path: str):
     if supabase is None:
         raise RuntimeError("Supabase não configurado")
 
-    buf = BytesIO()
-    df.to_excel(buf, index=False)
-    buf.seek(0)
-
-    supabase.storage.from_(SUPABASE_BUCKET).upload(
-        path=path,
-        file=buf.getvalue(),
-        file_options={
-            "content-type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            "upsert": "true",
-        },
-    )
+    # O sidecar antigo sai ANTES do .xlsx novo subir: se algo falhar no meio,
+    # quem lê cai no .xlsx, nunca num parquet desatualizado. Se nem a remoção
+    # der certo, o erro sobe e o .xlsx não é trocado.
+    sidecar = caminho_parquet(path)
+    supabase.storage.from_(SUPABASE_BUCKET).remove([sidecar])
+    invalidar_cache_download(sidecar)
+
+    supabase_upload_bytes(serializar_xlsx(df), path)
+
+    blob_parquet = serializar_parquet(df)
+    if blob_parquet is None:
+        return
+    try:
+        supabase_upload_bytes(blob_parquet, sidecar)
+        with _cache_lock:
+            _cache_sem_parquet.pop(path, None)
+    except Exception as e:
+        print(f"Erro enviando {sidecar} ao Supabase (fica só o .xlsx):", e)
+
+
+def gravar_bytes(conteudo: bytes, path: str):
+    # Grava num temporário e troca de uma vez: quem estiver baixando o arquivo
+    # nunca vê ele pela metade, e hard links antigos continuam apontando para a versão anterior.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(conteudo)
+        os.chmod(tmp, 0o644)  # mkstemp cria 0600; o nginx (X-Accel) precisa ler
+        os.replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def executar_em_paralelo(func, tarefas: list[tuple]) -> list[tuple[tuple, Exception]]:
+    """
+    Roda func(*args) para cada tupla de `tarefas` em threads (I/O: disco/rede).
+    Uma falha não interrompe as demais; devolve a lista de (args, erro) que falharam.
+    """
+    def executar(args):
+        try:
+            func(*args)
+            return None
+        except Exception as e:
+            return args, e
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS_IO) as ex:
+        resultados = list(ex.map(executar, tarefas))
+    return [r for r in resultados if r is not None]
+
+
+def salvar_outputs_locais(blobs: dict[str, bytes], competencia: str):
+    pasta_competencia = os.path.join(OUTPUT_DIR, competencia)
+    os.makedirs(pasta_competencia, exist_ok=True)
+
+    gravacoes = [(blob, OUTPUT_FILES[k]) for k, blob in blobs.items()]
+    falhas = executar_em_paralelo(gravar_bytes, gravacoes)
+    for (_, path), e in falhas:
+        print(f"Erro ao salvar {path}:", e)
+
+    # A cópia da competência tem os mesmos bytes do df_final.xlsx: hard link em vez de gravar de novo
+    copia_df_final = os.path.join(pasta_competencia, "df_final.xlsx")
+    try:
+        if os.path.exists(copia_df_final):
+            os.remove(copia_df_final)
+        os.link(OUTPUT_FILES["df_final"], copia_df_final)
+    except OSError:
+        gravar_bytes(blobs["df_final"], copia_df_final)
 
 
 # -----------------------
@@ -278,7 +609,7 @@ def parse_comp_versionid_from_df_final_path(df_final_path: str) -> tuple[str | N
     comp = df_final_path.split("/")[0]
     base = df_final_path.split("/")[-1]
 
-    if not re.match(r"^\d{4}-\d{2}$", comp):
+    if not _RE_COMPETENCIA.match(comp):
         return None, None
 
     mv = _RE_DF_FINAL_V.match(base)
@@ -339,15 +670,21 @@ def montar_contexto_dashboard(
     tabelas_fontes_dfs: dict[str, pd.DataFrame] | None = None,
     fontes_keys: dict[str, str] | None = None,
     links_fontes_override: dict[str, str] | None = None,
+    ja_arredondado: bool = False,
 ):
+    if not ja_arredondado:
+        arredondar_numericos(df_final)
     colunas_numericas = df_final.select_dtypes(include=["number"]).columns
-    df_final[colunas_numericas] = df_final[colunas_numericas].round(2)
 
-    df_display = df_final.copy()
-    for col in colunas_numericas:
-        df_display[col] = df_display[col].apply(
-            lambda x: f"{x:,.2f}".replace(",", "v").replace(".", ",").replace("v", ".")
-        )
+    # DataFrame novo a partir de um dict de Series (copy=False): as colunas numéricas
+    # entram formatadas e as demais são reaproveitadas de df_final sem cópia.
+    formatadas = {
+        col: df_final[col].map(lambda x: f"{x:,.2f}".translate(_BR_TRANS)) for col in colunas_numericas
+    }
+    df_display = pd.DataFrame(
+        {col: formatadas[col] if col in formatadas else df_final[col] for col in df_final.columns},
+        copy=False,
+    )
 
     tabela_html = df_display.to_html(
         classes="table table-striped table-bordered table-sm dataframe",
@@ -373,9 +710,25 @@ def montar_contexto_dashboard(
             index=False,
         )
 
+    caminhos_fontes = {}
+    comp, version_id = parse_comp_versionid_from_df_final_path(caminho_df_final or "")
+    if comp and version_id:
+        caminhos_fontes = {
+            nome_bonito: f"{comp}/{FONTE_ARQUIVOS_PREFIXO[chave]}_{version_id}.xlsx"
+            for nome_bonito, chave in FONTE_NOMES.items()
+        }
+
+    # Fontes podem ter milhares de linhas: quando a fonte está no Supabase, no HTML
+    # vai só uma prévia e a tabela completa é buscada sob demanda em /api/tabela (JSON).
+    # Sem caminho no Supabase (desativado ou upload falhou) vai a tabela inteira, como antes.
     tabelas_fontes = {}
-    if tabelas_fontes_dfs:
-        tabelas_fontes = {nome: df_to_html(df) for nome, df in tabelas_fontes_dfs.items()}
+    linhas_fontes = {}
+    for nome, df in (tabelas_fontes_dfs or {}).items():
+        if nome in caminhos_fontes:
+            tabelas_fontes[nome] = df_to_html(df.head(FONTE_PREVIEW_LINHAS))
+            linhas_fontes[nome] = len(df)
+        else:
+            tabelas_fontes[nome] = df_to_html(df)
 
     links_fontes = links_fontes_override if links_fontes_override is not None else montar_links_fontes_local()
 
@@ -393,6 +746,9 @@ def montar_contexto_dashboard(
         media_total=brl(media_total),
         max_total_val=brl(max_total),
         tabelas_fontes=tabelas_fontes,
+        linhas_fontes=linhas_fontes,
+        preview_linhas=FONTE_PREVIEW_LINHAS,
+        caminhos_fontes=caminhos_fontes,
         links_fontes=links_fontes,
         fontes_keys=(fontes_keys or {}),
         df_juntar=df_juntar_registros,
@@ -416,12 +772,33 @@ def index():
 @app.route("/api/arquivos")
 def api_arquivos():
     comp = (request.args.get("competencia") or "").strip()
-    if not re.match(r"^\d{4}-\d{2}$", comp):
+    if not _RE_COMPETENCIA.match(comp):
         return jsonify({"ok": False, "files": []})
     files = listar_df_final_por_competencia(comp)
     return jsonify({"ok": True, "files": files})
 
 
+@app.route("/api/tabela")
+def api_tabela():
+    """
+    Devolve uma planilha do Supabase em JSON (orient="split": columns + data),
+    usada pela aba Fontes para carregar a tabela completa sob demanda.
+    """
+    file_path = (request.args.get("file") or "").strip()
+    if not _RE_COMPETENCIA.match(file_path.split("/")[0]) or not file_path.endswith(".xlsx"):
+        return jsonify({"ok": False, "error": "Arquivo inválido."}), 400
+
+    df = carregar_excel_do_supabase(file_path)
+    if df is None:
+        return jsonify({"ok": False, "error": "Não consegui baixar/ler o Excel do Supabase."}), 404
+
+    # to_json (e não jsonify) para NaN virar null e datas virarem ISO
+    return app.response_class(
+        df.to_json(orient="split", index=False, date_format="iso"),
+        mimetype="application/json",
+    )
+
+
 @app.route("/api/substituir_fonte", methods=["POST"])
 def api_substituir_fonte():
     if supabase is None:
@@ -459,7 +836,7 @@ def api_substituir_fonte():
         dfs[k] = df_old
 
     try:
-        df_new = pd.read_excel(up_file)
+        df_new = ler_excel(up_file)
     except Exception as e:
         return jsonify({"ok": False, "error": f"Não consegui ler o Excel enviado: {e}"}), 400
 
@@ -481,8 +858,7 @@ def api_substituir_fonte():
     except Exception as e:
         return jsonify({"ok": False, "error": f"Erro ao recalcular comissões: {e}"}), 500
 
-    colunas_numericas = df_final_new.select_dtypes(include=["number"]).columns
-    df_final_new[colunas_numericas] = df_final_new[colunas_numericas].round(2)
+    arredondar_numericos(df_final_new)
 
     try:
         supabase_upload_df_upsert(df_final_new, caminhos["df_final"])
@@ -491,7 +867,7 @@ def api_substituir_fonte():
     except Exception as e:
         return jsonify({"ok": False, "error": f"Erro ao enviar atualização ao Supabase: {e}"}), 500
 
-    return jsonify({"ok": True, "redirect": url_for("visualizar_antigo", file=caminhos["df_final"])})
+    return jsonify({"ok": True, "redirect": url_for("visualizar_antigo", file=caminhos["df_final"], atualizado=1)})
 
 
 @app.route("/visualizar")
@@ -504,7 +880,7 @@ def visualizar_antigo():
     competencia = (request.args.get("competencia") or "").strip()
 
     if not file_path:
-        if not re.match(r"^\d{4}-\d{2}$", competencia):
+        if not _RE_COMPETENCIA.match(competencia):
             flash("Selecione uma competência válida para visualizar.")
             return redirect(url_for("index"))
         file_path = escolher_mais_recente_df_final(competencia)
@@ -512,15 +888,26 @@ def visualizar_antigo():
             flash("Não encontrei df_final para essa competência no Supabase.")
             return redirect(url_for("index"))
 
-    df_final = carregar_excel_do_supabase(file_path)
+    comp, version_id = parse_comp_versionid_from_df_final_path(file_path)
+
+    caminhos = {"df_final": file_path}
+    if comp and version_id:
+        caminhos["df_juntar"] = f"{comp}/df_juntar_{version_id}.xlsx"
+        for chave, prefixo in FONTE_ARQUIVOS_PREFIXO.items():
+            caminhos[chave] = f"{comp}/{prefixo}_{version_id}.xlsx"
+
+    # df_final, df_juntar e fontes são baixados ao mesmo tempo (latência = o mais lento, não a soma)
+    # Vindo de substituir/deletar fonte (atualizado=1) ignora o cache: os arquivos
+    # acabaram de ser regravados, possivelmente por outro worker.
+    dfs = carregar_excels_do_supabase(caminhos, usar_cache=not request.args.get("atualizado"))
+
+    df_final = dfs["df_final"]
     if df_final is None:
         flash("Não consegui baixar/ler o Excel selecionado do Supabase.")
         return redirect(url_for("index"))
 
-    comp, version_id = parse_comp_versionid_from_df_final_path(file_path)
-
     competencia_label = "—"
-    if comp and re.match(r"^\d{4}-\d{2}$", comp):
+    if comp and _RE_COMPETENCIA.match(comp):
         competencia_label = f"{comp.split('-')[1]}/{comp.split('-')[0]}"
 
     df_juntar = None
@@ -528,27 +915,11 @@ def visualizar_antigo():
     links_fontes = None
 
     if comp and version_id:
-        caminhos = {
-            "df_juntar": f"{comp}/df_juntar_{version_id}.xlsx",
-            "pj1": f"{comp}/pj1_{version_id}.xlsx",
-            "seg": f"{comp}/seguro_pj_{version_id}.xlsx",
-            "cam": f"{comp}/cambio_{version_id}.xlsx",
-            "co_ter": f"{comp}/co_corretagem_terceiras_{version_id}.xlsx",
-            "co_xpvp": f"{comp}/co_corretagem_xpvp_{version_id}.xlsx",
-            "cre": f"{comp}/credito_{version_id}.xlsx",
-            "xpcs": f"{comp}/xpcs_{version_id}.xlsx",
-            "lan_man": f"{comp}/lancamentos_manuais_{version_id}.xlsx",
-            "tim_rep": f"{comp}/times_repasses_{version_id}.xlsx",
-            "lan_pro": f"{comp}/lancamento_produtos_{version_id}.xlsx",
-        }
-
-        df_juntar = carregar_excel_do_supabase(caminhos["df_juntar"])
+        df_juntar = dfs["df_juntar"]
 
-        tabelas_fontes_dfs = {}
-        for nome_bonito, chave in FONTE_NOMES.items():
-            df_tmp = carregar_excel_do_supabase(caminhos[chave])
-            if df_tmp is not None:
-                tabelas_fontes_dfs[nome_bonito] = df_tmp
+        tabelas_fontes_dfs = {
+            nome_bonito: dfs[chave] for nome_bonito, chave in FONTE_NOMES.items() if dfs[chave] is not None
+        }
 
         if not tabelas_fontes_dfs:
             tabelas_fontes_dfs = None
@@ -574,7 +945,7 @@ def processar():
     arquivos = request.files.getlist("files")
 
     competencia = (request.form.get("competencia") or "").strip()
-    if not re.match(r"^\d{4}-\d{2}$", competencia):
+    if not _RE_COMPETENCIA.match(competencia):
         flash("Selecione a competência (mês/ano) antes de processar.")
         return redirect(url_for("index"))
 
@@ -595,42 +966,50 @@ def processar():
         )
         return redirect(url_for("index"))
 
-    pj1 = pd.read_excel(slots["pj1"])
-    seg = pd.read_excel(slots["seg"])
-    cam = pd.read_excel(slots["cam"])
-    co_ter = pd.read_excel(slots["co_ter"])
-    co_xpvp = pd.read_excel(slots["co_xpvp"])
-    cre = pd.read_excel(slots["cre"])
-    xpcs = pd.read_excel(slots["xpcs"])
-    lan_man = pd.read_excel(slots["lan_man"])
-    tim_rep = pd.read_excel(slots["tim_rep"])
-    lan_pro = pd.read_excel(slots["lan_pro"])
+    # Lê os bytes de cada upload uma única vez: servem para o parse e, quando o
+    # arquivo já é .xlsx, vão direto para o disco/Supabase sem re-serializar.
+    brutos = {k: f.read() for k, f in slots.items()}
+
+    # As 10 planilhas são independentes: o parse roda em paralelo
+    with ThreadPoolExecutor(max_workers=min(len(FONTE_KEYS), os.cpu_count() or 4)) as ex:
+        lidos = dict(zip(FONTE_KEYS, ex.map(lambda k: ler_excel(BytesIO(brutos[k])), FONTE_KEYS)))
+
+    pj1, seg, cam, co_ter, co_xpvp, cre, xpcs, lan_man, tim_rep, lan_pro = (lidos[k] for k in FONTE_KEYS)
 
     df_final, df_juntar = calcular_comissoes(
         pj1, seg, cam, co_ter, co_xpvp, cre, xpcs, lan_man, tim_rep, lan_pro
     )
 
-    colunas_numericas = df_final.select_dtypes(include=["number"]).columns
-    df_final[colunas_numericas] = df_final[colunas_numericas].round(2)
-
-    if not os.getenv("VERCEL"):
-        pasta_competencia = os.path.join(OUTPUT_DIR, prefixo_competencia)
-        os.makedirs(pasta_competencia, exist_ok=True)
-
-        df_final.to_excel(OUTPUT_FILES["df_final"], index=False)
-        df_juntar.to_excel(OUTPUT_FILES["df_juntar"], index=False)
-        pj1.to_excel(OUTPUT_FILES["pj1"], index=False)
-        seg.to_excel(OUTPUT_FILES["seg"], index=False)
-        cam.to_excel(OUTPUT_FILES["cam"], index=False)
-        co_ter.to_excel(OUTPUT_FILES["co_ter"], index=False)
-        co_xpvp.to_excel(OUTPUT_FILES["co_xpvp"], index=False)
-        cre.to_excel(OUTPUT_FILES["cre"], index=False)
-        xpcs.to_excel(OUTPUT_FILES["xpcs"], index=False)
-        lan_man.to_excel(OUTPUT_FILES["lan_man"], index=False)
-        tim_rep.to_excel(OUTPUT_FILES["tim_rep"], index=False)
-        lan_pro.to_excel(OUTPUT_FILES["lan_pro"], index=False)
-
-        df_final.to_excel(os.path.join(pasta_competencia, "df_final.xlsx"), index=False)
+    arredondar_numericos(df_final)
+
+    # Cada planilha vira bytes uma única vez: os mesmos bytes vão para o disco e para o Supabase
+    dfs_saida = {
+        "df_final": df_final,
+        "df_juntar": df_juntar,
+        "pj1": pj1,
+        "seg": seg,
+        "cam": cam,
+        "co_ter": co_ter,
+        "co_xpvp": co_xpvp,
+        "cre": cre,
+        "xpcs": xpcs,
+        "lan_man": lan_man,
+        "tim_rep": tim_rep,
+        "lan_pro": lan_pro,
+    }
+    blobs = {}
+    if not IS_SERVERLESS or supabase is not None:
+        blobs = {k: brutos[k] for k in FONTE_KEYS if (slots[k].filename or "").lower().endswith(".xlsx")}
+        a_serializar = {k: df for k, df in dfs_saida.items() if k not in blobs}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS_IO) as ex:
+            blobs.update(zip(a_serializar, ex.map(serializar_xlsx, a_serializar.values())))
+
+    if not IS_SERVERLESS:
+        try:
+            salvar_outputs_locais(blobs, prefixo_competencia)
+        except OSError as e:
+            # FS somente-leitura/cheio: segue sem cópia local (igual às demais falhas de gravação)
+            print("Erro ao salvar os outputs locais:", e)
 
     nome_arquivo_df_final = None
 
@@ -642,33 +1021,50 @@ def processar():
             prox = proxima_versao_da_competencia(prefixo_competencia)
             version_id = f"v{prox}"
 
-            def upload_df(df: pd.DataFrame, path: str):
-                buf = BytesIO()
-                df.to_excel(buf, index=False)
-                buf.seek(0)
-                supabase.storage.from_(SUPABASE_BUCKET).upload(
-                    path=path,
-                    file=buf.getvalue(),
-                    file_options={
-                        "content-type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        "upsert": "true",
-                    },
+            nome_arquivo_df_final = f"{prefixo_competencia}/df_final_{version_id}.xlsx"
+
+            caminhos_upload = {
+                "df_final": nome_arquivo_df_final,
+                "df_juntar": f"{prefixo_competencia}/df_juntar_{version_id}.xlsx",
+            }
+            for k in FONTE_KEYS:
+                prefixo = FONTE_ARQUIVOS_PREFIXO[k]
+                caminhos_upload[k] = f"{prefixo_competencia}/{prefixo}_{version_id}.xlsx"
+
+            # Sidecars .parquet (leitura rápida no /visualizar); sobem junto com os .xlsx
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS_IO) as ex:
+                blobs_parquet = dict(zip(dfs_saida, ex.map(serializar_parquet, dfs_saida.values())))
+
+            uploads = [(blobs[k], path) for k, path in caminhos_upload.items()]
+            sidecars = [
+                (blobs_parquet[k], caminho_parquet(path))
+                for k, path in caminhos_upload.items()
+                if blobs_parquet[k] is not None
+            ]
+
+            falhas_todas = executar_em_paralelo(supabase_upload_bytes, uploads + sidecars)
+            falhas = [f for f in falhas_todas if not f[0][1].endswith(".parquet")]
+            for (_, path), e in falhas_todas:
+                if path.endswith(".parquet"):
+                    print(f"Erro ao enviar {path} para o Supabase (o .xlsx segue valendo):", e)
+
+            if falhas:
+                for (_, path), e in falhas:
+                    print(f"Erro ao enviar {path} para o Supabase:", e)
+                nomes = ", ".join(path.split("/")[-1] for (_, path), _ in falhas)
+                flash(
+                    f"Não consegui enviar {len(falhas)} de {len(uploads)} Excels para o Supabase ({nomes}). "
+                    "Você ainda pode ver a tabela na tela."
+                )
+                nome_arquivo_df_final = None
+            elif not registrar_df_final_no_indice(prefixo_competencia, nome_arquivo_df_final):
+                flash(
+                    "Os Excels foram enviados, mas não consegui registrar a versião no índice do Supabase. "
+                    "Você ainda pode ver a tabela na tela."
                 )
+                nome_arquivo_df_final = None
 
-            nome_arquivo_df_final = f"{prefixo_competencia}/df_final_{version_id}.xlsx"
-            upload_df(df_final, nome_arquivo_df_final)
-
-            upload_df(df_juntar, f"{prefixo_competencia}/df_juntar_{version_id}.xlsx")
-            upload_df(pj1, f"{prefixo_competencia}/pj1_{version_id}.xlsx")
-            upload_df(seg, f"{prefixo_competencia}/seguro_pj_{version_id}.xlsx")
-            upload_df(cam, f"{prefixo_competencia}/cambio_{version_id}.xlsx")
-            upload_df(co_ter, f"{prefixo_competencia}/co_corretagem_terceiras_{version_id}.xlsx")
-            upload_df(co_xpvp, f"{prefixo_competencia}/co_corretagem_xpvp_{version_id}.xlsx")
-            upload_df(cre, f"{prefixo_competencia}/credito_{version_id}.xlsx")
-            upload_df(xpcs, f"{prefixo_competencia}/xpcs_{version_id}.xlsx")
-            upload_df(lan_man, f"{prefixo_competencia}/lancamentos_manuais_{version_id}.xlsx")
-            upload_df(tim_rep, f"{prefixo_competencia}/times_repasses_{version_id}.xlsx")
-            upload_df(lan_pro, f"{prefixo_competencia}/lancamento_produtos_{version_id}.xlsx")
+            invalidar_cache_listagens(prefixo_competencia)
 
         except Exception as e:
             print("Erro ao fazer upload para o Supabase:", e)
@@ -695,6 +1091,7 @@ def processar():
         df_juntar=df_juntar,
         tabelas_fontes_dfs=tabelas_fontes_dfs,
         fontes_keys=FONTE_NOMES,
+        ja_arredondado=True,
     )
 
     contexto["max_total"] = contexto.pop("max_total_val")
@@ -704,13 +1101,42 @@ def processar():
 # 6) DOWNLOADS
 # =====================================================================
 
+# Atrás de um nginx, USE_XACCEL=1 faz o próprio proxy entregar o arquivo
+# (location interna apontando para OUTPUT_DIR, ex.: /protected/).
+XACCEL_PREFIX = os.getenv("XACCEL_PREFIX", "/protected")
+
+
+def enviar_arquivo_local(path: str):
+    nome = os.path.basename(path)
+    if os.getenv("USE_XACCEL"):
+        rel = os.path.relpath(path, OUTPUT_DIR).replace(os.sep, "/")
+        resp = make_response("")
+        resp.headers["X-Accel-Redirect"] = f"{XACCEL_PREFIX.rstrip('/')}/{rel}"
+        resp.headers["Content-Type"] = CONTENT_TYPE_XLSX
+        resp.headers["Content-Disposition"] = f'attachment; filename="{nome}"'
+        return resp
+
+    # conditional/etag: downloads repetidos do mesmo arquivo viram 304 sem reler o disco.
+    # max_age=0: a URL é sempre a mesma e o conteúdo muda a cada /processar,
+    # então o cliente sempre revalida (e recebe 304 se nada mudou).
+    return send_file(
+        path,
+        as_attachment=True,
+        download_name=nome,
+        conditional=True,
+        etag=True,
+        last_modified=os.path.getmtime(path),
+        max_age=0,
+    )
+
+
 @app.route("/download")
 def download():
-    path = OUTPUT_FILES["df_final"]
-    if not os.path.exists(path):
+    path = OUTPUT_FILES.get("df_final")
+    if not path or not os.path.exists(path):
         flash("Arquivo df_final.xlsx não existe no servidor (use o download via Supabase).")
         return redirect(url_for("index"))
-    return send_file(path, as_attachment=True)
+    return enviar_arquivo_local(path)
 
 
 @app.route("/api/deletar_fonte", methods=["POST"])
@@ -772,7 +1198,7 @@ def api_deletar_fonte():
         supabase_upload_df_upsert(df_final, df_final_path)
         supabase_upload_df_upsert(df_juntar, caminhos["df_juntar"])
 
-        return jsonify({"ok": True, "redirect": url_for("visualizar_antigo", file=df_final_path)})
+        return jsonify({"ok": True, "redirect": url_for("visualizar_antigo", file=df_final_path, atualizado=1)})
 
     except Exception as e:
         return jsonify({"ok": False, "error": f"Erro ao deletar/recalcular: {e}"}), 500
@@ -784,7 +1210,10 @@ def download_excel(nome):
     if not path or not os.path.exists(path):
         flash("Arquivo não encontrado para download local.")
         return redirect(url_for("index"))
-    return send_file(path, as_attachment=True)
+    return enviar_arquivo_local(path)
+
+
+SIGNED_URL_EXPIRA_SEG = 60
 
 
 @app.route("/download_supabase")
@@ -799,6 +1228,15 @@ def download_supabase():
         flash("Supabase não está configurado. Não foi possível baixar o arquivo.")
         return redirect(url_for("index"))
 
+    # URL assinada: não exige bucket público e é cacheada pelo CDN do Supabase
+    try:
+        res = supabase.storage.from_(SUPABASE_BUCKET).create_signed_url(nome_arquivo, SIGNED_URL_EXPIRA_SEG)
+        url_assinada = res.get("signedURL") or res.get("signedUrl")
+        if url_assinada:
+            return redirect(url_assinada)
+    except Exception as e:
+        print("Erro ao gerar URL assinada no Supabase:", e)
+
     base_public_url = f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}"
     url_arquivo = f"{base_public_url}/{nome_arquivo}"
     return redirect(url_arquivo)
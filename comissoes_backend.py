@@ -842,17 +842,17 @@ def calcular_comissoes(pj1, seg, cam, co_ter, co_xpvp, cre, xpcs, lan_man, tim_r
     # 14) Monta df_juntar (base detalhada)
     # =====================================
     lan_man["Valor Assessor"] = lan_man["Valor"]
-    valores_debitar = lan_man['Debitar de'].dropna().unique()
-    novas_linhas = []
-
-    for codigo_debitar in valores_debitar:
-        linhas_modificadas = lan_man[lan_man['Debitar de'] == codigo_debitar].copy()
-        linhas_modificadas['Código'] = codigo_debitar
-        linhas_modificadas['Valor Assessor'] = linhas_modificadas['Valor negativado']
-        novas_linhas.append(linhas_modificadas)
-
-    if novas_linhas:
-        lan_man = pd.concat([lan_man] + novas_linhas, ignore_index=True)
+    # Uma linha de débito para cada lançamento com "Debitar de" preenchido, numa
+    # única seleção (sem filtrar o DataFrame inteiro uma vez por código).
+    # O sort estável mantém a ordem antiga: agrupado por código, na ordem em que aparecem.
+    linhas_debito = lan_man[lan_man['Debitar de'].notna()]
+    ordem_codigos = pd.factorize(linhas_debito['Debitar de'])[0]
+    linhas_debito = linhas_debito.iloc[np.argsort(ordem_codigos, kind='stable')].copy()
+    linhas_debito['Código'] = linhas_debito['Debitar de']
+    linhas_debito['Valor Assessor'] = linhas_debito['Valor negativado']
+
+    if not linhas_debito.empty:
+        lan_man = pd.concat([lan_man, linhas_debito], ignore_index=True)
 
     pj1_juntar = pj1_final[[
         "Cód. Assessor Direto", "Categoria", "Produto", "Cód. Cliente",
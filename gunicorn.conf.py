@@ -0,0 +1,29 @@
+# gunicorn.conf.py
+#
+# Servidor de produção (fora da Vercel). O gunicorn lê este arquivo sozinho:
+#
+#     gunicorn app:app
+#
+# Em desenvolvimento continue usando `python app.py` (servidor do Flask).
+#
+# gthread: as rotas passam a maior parte do tempo esperando o Supabase (rede),
+# então threads por worker sobrepõem essas esperas. preload_app importa o app
+# (pandas etc.) uma vez no master e os workers herdam via fork.
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+worker_class = "gthread"
+preload_app = True
+# processar lê/calcula/sobe ~12 planilhas: precisa de mais que os 30s padrão
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+
+def post_fork(server, worker):
+    # O client do Supabase criado no master (preload) não deve ser compartilhado
+    # entre processos: cada worker cria o seu.
+    import app
+
+    app.supabase = app.criar_cliente_supabase()
@@ -0,0 +1,50 @@
+-- Índice dos df_final enviados pelo /processar.
+-- Listar competências/versões por aqui é um SELECT indexado, em vez de varrer
+-- o storage com storage.list().
+
+create table if not exists public.competencia_files (
+    bucket text not null,
+    competencia text not null,
+    path text not null,
+    created_at timestamptz not null default now(),
+    primary key (bucket, path)
+);
+
+create index if not exists competencia_files_bucket_competencia_created_at_idx
+    on public.competencia_files (bucket, competencia, created_at desc);
+
+-- Competências distintas (o app não precisa trazer uma linha por versão)
+create or replace view public.competencia_files_competencias
+with (security_invoker = true) as
+select distinct bucket, competencia
+from public.competencia_files;
+
+-- Leitura e escrita liberadas para anon e authenticated: o servidor usa a
+-- anon key como SUPABASE_KEY (a mesma que já sobe os arquivos no storage) e
+-- precisa registrar cada versão nova. A service_role ignora RLS.
+alter table public.competencia_files enable row level security;
+
+create policy "competencia_files_select"
+    on public.competencia_files for select
+    to anon, authenticated
+    using (true);
+
+create policy "competencia_files_insert"
+    on public.competencia_files for insert
+    to anon, authenticated
+    with check (true);
+
+create policy "competencia_files_update"
+    on public.competencia_files for update
+    to anon, authenticated
+    using (true)
+    with check (true);
+
+-- Backfill com os df_final que já estão no storage, de qualquer bucket (a coluna
+-- bucket separa os ambientes). O app também faz esse backfill sozinho na
+-- primeira vez que registra uma versão com o índice vazio para o seu bucket.
+insert into public.competencia_files (bucket, competencia, path, created_at)
+select bucket_id, split_part(name, '/', 1), name, created_at
+from storage.objects
+where name ~ '^\d{4}-\d{2}/df_final_(v\d+|\d{8}_\d{6})\.xlsx$'
+on conflict (bucket, path) do nothing;
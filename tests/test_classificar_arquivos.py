@@ -0,0 +1,72 @@
+import unicodedata
+from types import SimpleNamespace
+
+import pytest
+
+from app import FONTE_KEYS, classificar_arquivos, normalizar_nome_arquivo
+
+
+def arquivo(nome):
+    return SimpleNamespace(filename=nome)
+
+
+def nfd(nome):
+    return unicodedata.normalize("NFD", nome)
+
+
+# (nome com acento, nome sem acento, fonte esperada)
+CASOS = [
+    ("Seguro PJ.xlsx", "Seguro PJ.xlsx", "seg"),
+    ("Câmbio.xlsx", "Cambio.xlsx", "cam"),
+    ("Co-corretagem Terceiras.xlsx", "Co-corretagem Terceiras.xlsx", "co_ter"),
+    ("Co-corretagem XPVP.xlsx", "Co-corretagem XPVP.xlsx", "co_xpvp"),
+    ("Crédito.xlsx", "Credito.xlsx", "cre"),
+    ("XPCS.xlsx", "XPCS.xlsx", "xpcs"),
+    ("Lançamentos Manuais.xlsx", "Lancamentos Manuais.xlsx", "lan_man"),
+    ("Times e Repasses.xlsx", "Times e Repasses.xlsx", "tim_rep"),
+    ("Lançamento de Produtos.xlsx", "Lancamento de Produtos.xlsx", "lan_pro"),
+]
+
+
+def arquivos_completos(**trocas):
+    """Um arquivo por fonte (+ PJ1); `trocas` substitui o nome de uma fonte."""
+    nomes = {chave: sem_acento for _, sem_acento, chave in CASOS}
+    nomes.update(trocas)
+    return [arquivo("Base PJ1.xlsx")] + [arquivo(n) for n in nomes.values()]
+
+
+def test_normalizar_nome_arquivo_remove_acentos_e_caixa():
+    assert normalizar_nome_arquivo("Lançamentos Manuais - CÂMBIO.xlsx") == "lancamentos manuais - cambio.xlsx"
+
+
+def test_normalizar_nome_arquivo_aceita_nfd():
+    assert normalizar_nome_arquivo(nfd("Crédito.xlsx")) == "credito.xlsx"
+
+
+@pytest.mark.parametrize("com_acento, sem_acento, chave", CASOS)
+def test_classifica_cada_fonte_com_e_sem_acento(com_acento, sem_acento, chave):
+    for nome in (com_acento, sem_acento, nfd(com_acento)):
+        slots, faltando = classificar_arquivos(arquivos_completos(**{chave: nome}))
+        assert slots[chave].filename == nome
+        assert faltando == []
+
+
+def test_pj1_e_o_arquivo_sem_palavra_chave():
+    slots, faltando = classificar_arquivos(arquivos_completos())
+    assert slots["pj1"].filename == "Base PJ1.xlsx"
+    assert faltando == []
+    assert set(slots) == set(FONTE_KEYS)
+
+
+def test_segundo_arquivo_com_palavra_ja_usada_vira_candidato_a_pj1():
+    arquivos = [arquivo("Seguro PJ.xlsx"), arquivo("Seguro PJ (cópia).xlsx")]
+    slots, faltando = classificar_arquivos(arquivos)
+    assert slots["seg"].filename == "Seguro PJ.xlsx"
+    assert slots["pj1"].filename == "Seguro PJ (cópia).xlsx"
+    assert "seg" not in faltando and "pj1" not in faltando
+
+
+def test_fontes_nao_enviadas_aparecem_em_faltando():
+    slots, faltando = classificar_arquivos([arquivo("Câmbio.xlsx")])
+    assert slots["cam"] is not None
+    assert set(faltando) == set(FONTE_KEYS) - {"cam"}